@@ -1,17 +1,75 @@
 import os
+import ast
+import functools
+import importlib.util
 from dataclasses import dataclass, field
 from typing import Any, List, Union
 import json
-from collections import defaultdict
+from itertools import chain
 
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError: # numba is optional, the numpy versions of the kernels are used instead
+    NUMBA_AVAILABLE = False
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+# pyarrow is optional as well, it only speeds up reading the grouped tsv file
+PYARROW_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
 
 from utils import log
 
+class BucketSampler(Sampler):
+    """
+    batch sampler that groups samples of similar length so that collate pads to near uniform lengths.
+    when the average length is much smaller than the maximum this roughly halves the padded tokens
+    compared to random batching, and with them the collate memory and the wasted model compute.
+    """
+
+    def __init__(self, lengths, indices, batch_size, shuffle_window=None, drop_last=False) -> None:
+        indices = np.asarray(indices)
+        self._len_sort = indices[np.argsort(np.asarray(lengths)[indices], kind="stable")]
+        self.batch_size = batch_size
+        # samples are shuffled within windows of the sorted order to keep some randomness inside the buckets
+        self.shuffle_window = shuffle_window if shuffle_window is not None else batch_size * 4
+        self.drop_last = drop_last
+        # own random state, so outliers generated in another thread do not share draws with it
+        self._rng = np.random.RandomState(np.random.randint(2**31))
+
+    def __iter__(self):
+        order = self._len_sort.copy()
+        for start in range(0, len(order), self.shuffle_window):
+            self._rng.shuffle(order[start:start + self.shuffle_window])
+
+        batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+
+        for batch_id in self._rng.permutation(len(batches)):
+            yield batches[batch_id].tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self._len_sort) // self.batch_size
+        return (len(self._len_sort) + self.batch_size - 1) // self.batch_size
+
+@functools.lru_cache(maxsize=None)
+def _load_vocab(vocab_file_path):
+    """
+    load a vocab file and its reverse map once per path, shared by every dataset instance
+    """
+    with open(vocab_file_path, "r", encoding="utf-8") as f:
+        vocab = json.load(f)
+
+    return vocab, {value:item for item, value in vocab.items()}
+
 class VocabDictionary(object):
     """
     dictionary to map trajectory semantics to tokens
@@ -19,10 +77,23 @@ class VocabDictionary(object):
 
     def __init__(self, vocab_file_path) -> None:
 
-        with open(vocab_file_path, "r", encoding="utf-8") as f:
-            self.vocab = json.load(f)
+        self.vocab, self.reverse_map_vocab = _load_vocab(vocab_file_path)
+        self._pad_tok = self.vocab[self.pad()]
+        self._eot_tok = self.vocab[self.eot()]
+
+        # direct lookup table for the integer keys (e.g. grid cells) so they can be encoded without the dict, -1 marks missing keys
+        int_keys = [int(key) for key in self.vocab if key.isdigit() and str(int(key)) == key]
+        self.int_lut = np.full(max(int_keys, default=-1) + 1, -1, dtype=np.int32)
+        for key in int_keys:
+            self.int_lut[key] = self.vocab[str(key)]
 
-        self.reverse_map_vocab = {value:item for item, value in self.vocab.items()}
+        # reverse lookup tables from the tokens to the words and to the integer keys
+        self.word_lut = np.empty(max(self.reverse_map_vocab, default=-1) + 1, dtype=object)
+        for token, word in self.reverse_map_vocab.items():
+            self.word_lut[token] = word
+        self.int_rlut = np.full(len(self.word_lut), -1, dtype=np.int32)
+        for key in int_keys:
+            self.int_rlut[self.vocab[str(key)]] = key
 
     def __len__(self):
         return len(self.vocab)
@@ -39,6 +110,31 @@ class VocabDictionary(object):
             
 
         return tokens
+
+    def encode_batch(self, words:Union[List[str], List[int], np.ndarray]):
+        """
+        encode a flat sequence of words with a single vectorized vocab lookup
+        """
+        tokens = pd.Series(words, dtype=object).astype(str).map(self.vocab)
+        missing = tokens.isna()
+        if missing.any():
+            raise KeyError(str(words[int(np.flatnonzero(missing.to_numpy())[0])]))
+
+        return tokens.to_numpy(dtype=np.int32)
+
+    def encode_ints(self, trajectory:Union[List[int], np.ndarray]):
+        """
+        encode a trajectory of integer keys in a single lookup into int_lut
+        """
+        keys = np.asarray(trajectory, dtype=np.int64)
+        tokens = np.full(keys.shape, -1, dtype=np.int32)
+        in_range = (keys >= 0) & (keys < len(self.int_lut))
+        tokens[in_range] = self.int_lut[keys[in_range]]
+        invalid = tokens < 0
+        if invalid.any():
+            raise KeyError(str(keys[np.flatnonzero(invalid)[0]]))
+
+        return tokens
     
     def decode(self, tokens:List[int]):
         """
@@ -50,14 +146,40 @@ class VocabDictionary(object):
 
         return trajectory
 
+    def _check_tokens(self, tokens, lut, missing):
+        """
+        look tokens up in a reverse lookup table, raising KeyError like decode for unknown tokens
+        """
+        tokens = np.asarray(tokens, dtype=np.int64)
+        in_range = (tokens >= 0) & (tokens < len(lut))
+        values = np.full(tokens.shape, missing, dtype=lut.dtype)
+        values[in_range] = lut[tokens[in_range]]
+        invalid = values == missing
+        if invalid.any():
+            raise KeyError(int(tokens[np.flatnonzero(invalid)[0]]))
+
+        return values
+
+    def decode_batch(self, tokens:Union[List[int], np.ndarray]):
+        """
+        decode a flat sequence of tokens into their words in a single lookup into word_lut
+        """
+        return self._check_tokens(tokens, self.word_lut, None).tolist()
+
+    def decode_ints(self, tokens:Union[List[int], np.ndarray]):
+        """
+        decode a flat sequence of tokens back into their integer keys, the inverse of encode_ints
+        """
+        return self._check_tokens(tokens, self.int_rlut, -1)
+
     def pad(self):
         return "PAD"
     def eot(self):
             return "EOT"
     def pad_token(self):
-        return self.vocab[self.pad()]
+        return self._pad_tok
     def eot_token(self):
-        return self.vocab[self.eot()]
+        return self._eot_tok
 
 
 @dataclass
@@ -85,13 +207,26 @@ class POLDataset(Dataset):
         super().__init__()
 
         self.config = config
+        # order in which the selected features are interleaved for each point of a trajectory
+        self._feat_order = tuple(feature for feature in ("place", "gps", "duration", "distance") if feature in self.config.features)
+        self._k = len(self._feat_order)
 
         dictionary_path = self.get_dictionary_path()
 
         self.dictionary = VocabDictionary(dictionary_path)
         file_path = os.path.join(self.config.data_dir, f"{self.config.file_name}_grouped.tsv")
 
-        self.data, self.outliers = self.get_data(file_path)
+        # the frame is not kept, only the encoded trajectories and the fields __getitem__ reads.
+        # get_feature_vector and get_all_data decode the features back from encoded_data
+        data, outliers = self.get_data(file_path)
+        self._user_id = data["user_id"].to_numpy()
+        self._uid_int = data["user_id_int"].to_numpy()
+        self._date = data["date"].to_numpy()
+        self._is_outlier = data["is_outlier"].to_numpy()
+        self._outlier_uid = outliers["user_id_int"].to_numpy()
+        self._outlier_date = outliers["date"].to_numpy()
+        self.encoded_data, self.offsets = self.get_encoded_data(data)
+        self.lengths = np.diff(self.offsets)
 
         # pdb.set_trace()
         
@@ -106,7 +241,19 @@ class POLDataset(Dataset):
         else:
             print(message)
 
-        data = pd.read_csv(file_path, delimiter="\t")
+        if PYARROW_AVAILABLE:
+            # keep the dates as strings, pyarrow would otherwise infer a date type for them
+            data = pd.read_csv(file_path, delimiter="\t", engine="pyarrow", dtype={"date": str})
+        else:
+            data = pd.read_csv(file_path, delimiter="\t")
+
+        # the context size below is computed from the length of the unparsed token strings
+        data["token_str_len"] = data["token"].str.len()
+        # the list columns are stored as their python repr; parse them once here instead of on every __getitem__
+        for column in ["place", "token", "duration_bucket", "distance_label", "dayofweek"]:
+            data[column] = data[column].map(ast.literal_eval)
+        # only the first day of week of a daily trajectory is used in the feature vector
+        data["dow0"] = data["dayofweek"].map(lambda days: days[0])
         
         data["date_formated"] = pd.to_datetime(data["date"])
        
@@ -118,17 +265,18 @@ class POLDataset(Dataset):
         else:
             print(message)
 
-        data["user_id_int"] = data["user_id"].str.split("_").str[-1].astype(int)
+        data["user_id_int"] = data["user_id"].str.extract(r"_(\d+)$", expand=False).astype(np.int32)
         # grouped = data.groupby(by=["user_id", "date"]).agg(list).reset_index()
         outliers = data[(data["date_formated"] > (data["date_formated"].max() - pd.DateOffset(self.config.outlier_days)))].copy()
         outliers = outliers.loc[outliers['user_id_int'].isin(outlier_list)][["user_id_int", "date"]]
-        outliers["outlier"] = "outlier"
 
-        data= pd.merge(data, outliers,  how='left', left_on=['user_id_int','date'], right_on = ['user_id_int','date'])
-        data['outlier'] = np.where(data.outlier.notnull(), "outlier", "non outlier")
+        # tag the outlier days with a membership test on (user_id_int, date) instead of a merge
+        outlier_keys = list(zip(outliers["user_id_int"], outliers["date"]))
+        is_outlier = pd.MultiIndex.from_arrays([data["user_id_int"], data["date"]]).isin(outlier_keys)
+        data["is_outlier"] = is_outlier
 
         if not self.config.include_outliers:
-            data = data[data["outlier"] != "outlier"]
+            data = data.loc[~data["is_outlier"]].reset_index(drop=True)
 
         message=f"inlcude outliers: {self.config.include_outliers}"
 
@@ -139,7 +287,7 @@ class POLDataset(Dataset):
 
         # times len(self.config.features) because we may have more than one feature to include in the vector
         # plus 3 to account for the user_id, dayofweek and EOT
-        self.config.block_size = (data.token.str.len().max() * len(self.config.features)) + 3
+        self.config.block_size = (data.token_str_len.max() * len(self.config.features)) + 3
 
         message=f"context size: {self.config.block_size }"
 
@@ -150,6 +298,47 @@ class POLDataset(Dataset):
 
         return data, outliers
     
+    def get_encoded_data(self, data):
+        """
+        encode every daily trajectory once so that __getitem__ is a lookup.
+        the loop runs over the feature columns, not over the rows.
+        returns the flat token buffer and the offsets of the rows in it
+        """
+        if len(data) == 0:
+            return np.empty(0, dtype=np.int32), np.zeros(1, dtype=np.int64)
+
+        columns = {
+            "place": data["place"].to_numpy(),
+            "gps": data["token"].to_numpy(),
+            "duration": data["duration_bucket"].to_numpy(),
+            "distance": data["distance_label"].to_numpy()
+        }
+        # like zip over the feature lists, a row only has as many points as its shortest feature list
+        list_lengths = {feature: np.fromiter(map(len, column), dtype=np.int64, count=len(column)) for feature, column in columns.items()}
+        n_points = np.minimum.reduce(list(list_lengths.values()))
+
+        # every row is laid out as [user_id, dayofweek, k features per point..., EOT] in one flat buffer
+        row_lengths = 2 + n_points * self._k + 1
+        ends = np.cumsum(row_lengths)
+        starts = ends - row_lengths
+        encoded = np.empty(ends[-1], dtype=np.int32)
+
+        encoded[starts] = self.dictionary.encode_batch(data["user_id"].to_numpy())
+        encoded[starts + 1] = self.dictionary.encode_batch(data["dow0"].to_numpy())
+        encoded[ends - 1] = self.dictionary.eot_token()
+
+        # position of the first feature of every point, then one vocab lookup per feature column
+        point_index = np.arange(n_points.sum()) - np.repeat(np.cumsum(n_points) - n_points, n_points)
+        point_starts = np.repeat(starts + 2, n_points) + point_index * self._k
+        for offset, feature in enumerate(self._feat_order):
+            if np.array_equal(list_lengths[feature], n_points):
+                words = list(chain.from_iterable(columns[feature]))
+            else:
+                words = list(chain.from_iterable(values[:n] for values, n in zip(columns[feature], n_points)))
+            encoded[point_starts + offset] = self.dictionary.encode_batch(words)
+
+        return encoded, np.concatenate(([0], ends))
+
     def get_dictionary_path(self):
         """get vocab file name"""
         file_name = "vocab"
@@ -168,7 +357,7 @@ class POLDataset(Dataset):
 
         return path
     def get_outliers(self):
-        return self.outliers
+        return pd.DataFrame({"user_id_int": self._outlier_uid, "date": self._outlier_date})
     
     def partition_dataset(self, proportion=0.9, seed=123):
         np.random.seed(seed)
@@ -178,67 +367,32 @@ class POLDataset(Dataset):
         return train_indices, val_indices
      
     def __len__(self):
-        return len(self.data)
+        return len(self.lengths)
     
     def get_samples_for_user(self, user_id):
         """
         get the samples of a particular user given their user_id
         """
-        indices = self.data[self.data["user_id"] == f"user_{user_id}"].index.tolist()
+        indices = np.flatnonzero(self._user_id == f"user_{user_id}")
         samples = []
         for i in indices:
             samples.append(self.__getitem__(i))
 
         return samples
 
-    def get_feature_vector(self, sample:pd.core.series.Series):
+    def get_feature_vector(self, index:int):
         """
-        generate a feature vector for a given sample
+        generate a feature vector for the sample at a given position
         """
 
-        daily_trajectory_feature = [sample["user_id"], eval(sample["dayofweek"])[0]]
-
         # [user_id, dayofweek, place, token, duration_bucket, distance, place, token, duration_bucket, distance, ..., EOT]
         # [user_35, day_4, Workplace, 88, 0-60, near, Restaurant, 88, 0-60, near, ..., EOT]
-
-        places = eval(sample.place)
-        tokens = eval(sample.token)
-        duration_buckets = eval(sample.duration_bucket)
-        distances = eval(sample.distance_label)
-
-        for place, token, duration_bucket, distance in zip(places, tokens, duration_buckets, distances):
-            current_seq = []
-
-            if "place" in self.config.features:
-                current_seq.append(place)
-
-            if "gps" in self.config.features:
-                current_seq.append(str(token))
-
-            if "duration" in self.config.features:
-                current_seq.append(duration_bucket)
-
-            if "distance" in self.config.features:
-                current_seq.append(distance)
-            
-            daily_trajectory_feature.extend(current_seq)
-        
-        daily_trajectory_feature.append("EOT")
-        return daily_trajectory_feature
+        return self.dictionary.decode_batch(self.encoded_data[self.offsets[index]:self.offsets[index + 1]])
     
     def get_all_data(self):
 
-        data = defaultdict(list)
-        for i in tqdm(range(self.data.shape[0])):
-
-            sample = self.data.iloc[i]
-            daily_trajectory_feature = self.get_feature_vector(sample)
-
-            data["user_id_int"].append(sample.user_id_int)
-            data["date"].append(sample.date)
-            data["feature"].append(daily_trajectory_feature)
-
-            # pdb.set_trace()
+        words = self.dictionary.decode_batch(self.encoded_data)
+        features = [words[start:end] for start, end in zip(self.offsets[:-1], self.offsets[1:])]
 
         file_name = "data_with_features"
         if "gps" in self.config.features:
@@ -252,41 +406,35 @@ class POLDataset(Dataset):
 
         file_name += ".tsv"
 
-        data_df = pd.DataFrame(data)
-        data_df.to_csv(f"{self.config.data_dir}/{file_name}", sep="\t", index=False)
+        data_df = pd.DataFrame({"user_id_int": self._uid_int, "date": self._date, "feature": features})
+        data_df.to_csv(f"{self.config.data_dir}/{file_name}", sep="\t", index=False, chunksize=50000)
 
     def __getitem__(self, index) -> Any:
 
         # pdb.set_trace()
-        sample  = self.data.iloc[index]
-        daily_trajectory_feature = self.get_feature_vector(sample)   
-        tokens = self.dictionary.encode(daily_trajectory_feature)
-        metadata = [sample.user_id, sample.date, sample.outlier]
-
-        # ipdb.set_trace()
-        return (metadata,  tokens)
+        # the outlier flag is only turned into its display label here, when the metadata is emitted
+        metadata = [self._user_id[index], self._date[index], "outlier" if self._is_outlier[index] else "non outlier"]
+        return (metadata, self.encoded_data[self.offsets[index]:self.offsets[index + 1]])
     
     def collate(self, data):
         """
         collate function
         """
-        # max_length = len(max(token_lists, key=len))
-        masks = []
-        token_lists = []
         all_metadata = []
         
         # start_time = time.time()
         max_lenth = max([len(item[-1]) for item in data])
-        for metadata, tokens in data:
+        # pad into preallocated buffers
+        token_lists = np.full((len(data), max_lenth), self.dictionary.pad_token(), dtype=np.int64)
+        masks = np.zeros((len(data), max_lenth), dtype=np.int64)
+        for i, (metadata, tokens) in enumerate(data):
 
-            mask = [1] * len(tokens) + [0] * (max_lenth - len(tokens))
-            tokens_ = tokens +  (max_lenth - len(tokens)) * [self.dictionary.pad_token()]
-            token_lists.append(tokens_)
-            masks.append(mask)
+            token_lists[i, :len(tokens)] = tokens
+            masks[i, :len(tokens)] = 1
             all_metadata.append(metadata)
 
-        token_lists = torch.tensor(token_lists)
-        masks = torch.tensor(masks)
+        token_lists = torch.from_numpy(token_lists)
+        masks = torch.from_numpy(masks)
 
         # print(f"to batchify it took {time.time() - start_time}")
         return {
@@ -296,6 +444,42 @@ class POLDataset(Dataset):
         }
   
 
+# the 8 neighbouring directions a grid cell can be moved to
+PERTURB_OFFSETS = np.array([[0, 1], [1, 0], [-1, 0], [0, -1], [1, 1], [-1, -1], [-1, 1], [1, -1]], dtype=np.int64)
+
+@njit(cache=True)
+def _perturb_batch(points, out, probs, dx, dy, prob, level, height, width):
+    """
+    move every non zero point with probs[i] < prob by (dx[i], dy[i]) * level if it stays on the grid
+    """
+    for i in range(points.size):
+        p = points[i]
+        if p == 0 or probs[i] >= prob:
+            out[i] = p
+            continue
+        x = p // width
+        y = p % width
+        nx = x + dx[i] * level
+        ny = y + dy[i] * level
+        if 0 <= nx < height and 0 <= ny < width:
+            x = nx
+            y = ny
+        out[i] = x * width + y
+
+def _perturb_batch_numpy(points, out, probs, dx, dy, prob, level, height, width):
+    """
+    branchless numpy version of _perturb_batch, used when numba is not installed
+    """
+    x = points // width
+    y = points % width
+    nx = x + dx * level
+    ny = y + dy * level
+    on_grid = (nx >= 0) & (nx < height) & (ny >= 0) & (ny < width)
+    x = np.where(on_grid, nx, x)
+    y = np.where(on_grid, ny, y)
+    active = (points != 0) & (probs < prob)
+    out[:] = np.where(active, x * width + y, points)
+
 @dataclass
 class PortoConfig:
     """
@@ -322,9 +506,15 @@ class PortoDataset(Dataset):
         self.config = config
         dictionary_path = os.path.join(self.config.data_dir, "vocab.json")
         self.dictionary = VocabDictionary(dictionary_path)
+        self._sot_tok = self.dictionary.vocab["SOT"]
+        self._eot_tok = self.dictionary.eot_token()
+        self._pad_tok = self.dictionary.pad_token()
         file_path = os.path.join(self.config.data_dir, f"{self.config.file_name}.csv")
 
-        self.data, self.metadata = self.get_data(file_path)
+        # the parsed trajectories are not kept next to their encoded copy, get_trajectory decodes them back
+        trajectories, self.metadata = self.get_data(file_path)
+        self.encoded_data, self.offsets = self.get_encoded_data(trajectories)
+        self.lengths = np.diff(self.offsets)
         # pdb.set_trace()
         
     def get_data(self, file_path):
@@ -334,21 +524,12 @@ class PortoDataset(Dataset):
 
         print(f"loading the dataset ...")
         # pdb.set_trace()
-        trajectories = []
-        labels = []
-        sizes = []
-        i = 0
-        for traj in tqdm(open(file_path, 'r').readlines()):
-            traj = eval(traj)
-            trajectories.append(traj)
-            labels.append("non outlier")
-            sizes.append(len(traj))
-
-            # if i > 2000:
-            #     break
-            # i+=1
-        
-        sizes = np.array(sizes)
+        with open(file_path, 'r') as f:
+            raw_trajectories = f.read().splitlines()
+
+        trajectories = self._parse_trajectories(raw_trajectories, file_path, progress=True)
+        labels = ["non outlier"] * len(trajectories)
+        sizes = np.fromiter((traj.size for traj in trajectories), dtype=np.int64, count=len(trajectories))
         self.config.block_size = sizes.max() + 2 # to account for EOT and SOT 
         # pdb.set_trace()
         outlier_counts = 0
@@ -363,14 +544,12 @@ class PortoDataset(Dataset):
                 elif key == "detour":
                     label =  "detour outlier"
 
-                for traj in values:
-
-                    if len(traj) <= self.config.block_size - 2:
-                        trajectories.append(traj)
-                        labels.append(label)
-                        outlier_counts += 1
-                    else:
-                        skipped_long_trajectories += 1
+                # outliers longer than the context are skipped
+                kept = [traj for traj in values if traj.size <= self.config.block_size - 2]
+                trajectories.extend(kept)
+                labels.extend([label] * len(kept))
+                outlier_counts += len(kept)
+                skipped_long_trajectories += len(values) - len(kept)
 
         # sizes.sort()
         
@@ -379,8 +558,60 @@ class PortoDataset(Dataset):
         print(f"context size {self.config.block_size}")
 
         # pdb.set_trace()
-        sorted([trajectories], key=lambda k: len(k))
         return trajectories, labels
+    @staticmethod
+    def _parse_trajectories(lines, file_path, progress=False):
+        """
+        parse saved trajectory lines "[p1, p2, ...]" into int32 arrays in C
+        """
+        if progress:
+            # throttle the progress bar, the loop body is cheap
+            lines = tqdm(lines, mininterval=0.5, miniters=max(1, len(lines) // 200))
+
+        trajectories = []
+        for line_number, line in enumerate(lines, start=1):
+            line = line.strip()
+            points = line[1:-1]
+            try:
+                if not (line.startswith("[") and line.endswith("]")):
+                    raise ValueError("the trajectory is not enclosed in brackets")
+                trajectory = np.fromstring(points, sep=",", dtype=np.int32)
+                # on a malformed point fromstring may only warn and return the points before it, so check the count
+                if trajectory.size != (points.count(",") + 1 if points.strip() else 0):
+                    raise ValueError("the trajectory has points that are not integers")
+            except ValueError as e:
+                raise ValueError(f"cannot parse the trajectory at {file_path}:{line_number}: {line!r}") from e
+            trajectories.append(trajectory)
+
+        return trajectories
+
+    def get_encoded_data(self, trajectories):
+        """
+        encode every trajectory (with SOT and EOT) once so that __getitem__ is a lookup.
+        returns the flat token buffer and the offsets of the trajectories in it
+        """
+        if len(trajectories) == 0:
+            return np.empty(0, dtype=np.int32), np.zeros(1, dtype=np.int64)
+
+        sizes = np.fromiter((traj.size for traj in trajectories), dtype=np.int64, count=len(trajectories))
+        offsets = np.concatenate(([0], np.cumsum(sizes + 2)))
+        encoded = np.empty(offsets[-1], dtype=np.int32)
+
+        is_point = np.ones(offsets[-1], dtype=bool)
+        is_point[offsets[:-1]] = False
+        is_point[offsets[1:] - 1] = False
+        encoded[offsets[:-1]] = self._sot_tok
+        encoded[offsets[1:] - 1] = self._eot_tok
+        encoded[is_point] = self.dictionary.encode_ints(np.concatenate(trajectories))
+
+        return encoded, offsets
+
+    def get_trajectory(self, index:int):
+        """
+        decode the grid cells of the trajectory at a given position, without SOT and EOT
+        """
+        return self.dictionary.decode_ints(self.encoded_data[self.offsets[index] + 1:self.offsets[index + 1] - 1])
+
     def get_outliers(self):
         """
         load saved outliers
@@ -392,10 +623,11 @@ class PortoDataset(Dataset):
             file = f"{self.config.data_dir}/outliers/{outlier_type}_ratio_{self.config.outlier_ratio}_level_{self.config.outlier_level}_prob_{self.config.outlier_prob}.csv"
 
             try:
-                route_switched_outliers = open(file, 'r').readlines()
-                outliers[outlier_type] = [eval(traj) for traj in route_switched_outliers]
+                with open(file, 'r') as f:
+                    route_switched_outliers = f.read().splitlines()
             except Exception as e:
                 raise Exception(f"the file {file} cannot be found")
+            outliers[outlier_type] = self._parse_trajectories(route_switched_outliers, file)
             print(f"loaded {outlier_type} outliers")
         return outliers
         
@@ -414,12 +646,12 @@ class PortoDataset(Dataset):
         route_swithing_idx = np.random.randint(0, trajectory_count, size=int(trajectory_count * self.config.outlier_ratio))
         # [199340,  43567, 173685, ..., 150926, 233238, 224962]
         outliers["route_switch"] = self.get_route_switch_outliers(
-            [self.data[idx] for idx in route_swithing_idx],level=self.config.outlier_level, prob=self.config.outlier_prob)
+            [self.get_trajectory(idx) for idx in route_swithing_idx],level=self.config.outlier_level, prob=self.config.outlier_prob)
         
         np.random.seed(10)
         detour_idx = np.random.randint(0, trajectory_count, size=int(trajectory_count * self.config.outlier_ratio))
         # [ 83209, 236669,  94735, ...,  97329, 173664,  83412]
-        outliers["detour"] = self.get_detour_outliers([self.data[idx] for idx in detour_idx],
+        outliers["detour"] = self.get_detour_outliers([self.get_trajectory(idx) for idx in detour_idx],
                                       level=self.config.outlier_level, prob=self.config.outlier_prob, vary=False)
         # pdb.set_trace()
 
@@ -433,7 +665,7 @@ class PortoDataset(Dataset):
             
             fout = open(current_save_dir, "w")
             for traj in values:
-                fout.write(f"{traj}\n")
+                fout.write(f"{traj.tolist()}\n")
         
 
         return outliers
@@ -442,28 +674,35 @@ class PortoDataset(Dataset):
         """
         get route swithing outliers
         """
+        map_size = self.config.grip_size
+        # perturb the inner points of all the trajectories in one kernel call, with the random draws made upfront
+        inner_points = [traj[1:-1] for traj in batch_x]
+        points = np.concatenate(inner_points).astype(np.int64) if inner_points else np.empty(0, dtype=np.int64)
+        probs = np.random.random(points.size)
+        offsets = PERTURB_OFFSETS[np.random.randint(0, len(PERTURB_OFFSETS), size=points.size)]
+        perturbed = np.empty_like(points)
+        perturb_batch = _perturb_batch if NUMBA_AVAILABLE else _perturb_batch_numpy
+        perturb_batch(points, perturbed, probs, offsets[:, 0].copy(), offsets[:, 1].copy(), prob, level, map_size[0], map_size[1])
+
+        split_at = np.cumsum([len(inner) for inner in inner_points])[:-1]
         outliers = []
-        for traj in batch_x:
-            outliers.append([traj[0]] + [self._perturb_point(p, level)
-                                 if not p == 0 and np.random.random() < prob else p
-                                 for p in traj[1:-1]] + [traj[-1]])
+        for traj, inner in zip(batch_x, np.split(perturbed, split_at)):
+            outliers.append(np.concatenate((traj[:1], inner.astype(traj.dtype), traj[-1:])))
         return outliers
     
-    def _perturb_point(self, point, level, offset=None):
+    def _perturb_segment(self, points, level, offset):
         """
-        -
+        move all the points of a segment by the same offset * level, keeping the points that would leave the grid
         """
         map_size = self.config.grip_size
-        x, y = int(point // map_size[1]), int(point % map_size[1])
-        if offset is None:
-            offset = [[0, 1], [1, 0], [-1, 0], [0, -1], [1, 1], [-1, -1], [-1, 1], [1, -1]]
-            x_offset, y_offset = offset[np.random.randint(0, len(offset))]
-        else:
-            x_offset, y_offset = offset
-        if 0 <= x + x_offset * level < map_size[0] and 0 <= y + y_offset * level < map_size[1]:
-            x += x_offset * level
-            y += y_offset * level
-        return int(x * map_size[1] + y)
+        x_offset, y_offset = offset
+        points = np.asarray(points, dtype=np.int64)
+        x, y = points // map_size[1], points % map_size[1]
+        nx, ny = x + x_offset * level, y + y_offset * level
+        on_grid = (nx >= 0) & (nx < map_size[0]) & (ny >= 0) & (ny < map_size[1])
+        x = np.where(on_grid, nx, x)
+        y = np.where(on_grid, ny, y)
+        return (x * map_size[1] + y).astype(np.int64)
     
     def get_detour_outliers(self, batch_x, level, prob, vary=False):
         map_size = self.config.grip_size
@@ -491,9 +730,8 @@ class PortoDataset(Dataset):
             else:
                 offset = [offset[0] / div0, -offset[1] / div1]
 
-            outliers.append(traj[:anomaly_st_loc] +
-                                 [self._perturb_point(p, level, offset) for p in traj[anomaly_st_loc:anomaly_ed_loc]] +
-                                 traj[anomaly_ed_loc:])
+            anomaly = self._perturb_segment(traj[anomaly_st_loc:anomaly_ed_loc], level, offset).astype(traj.dtype)
+            outliers.append(np.concatenate((traj[:anomaly_st_loc], anomaly, traj[anomaly_ed_loc:])))
         return outliers
     
     def partition_dataset(self, proportion=0.9, seed=123):
@@ -504,37 +742,29 @@ class PortoDataset(Dataset):
         return train_indices, val_indices
      
     def __len__(self):
-        return len(self.data)
+        return len(self.lengths)
 
     def __getitem__(self, index) -> Any:
 
-        sample  = self.data[index]
-        sample = ["SOT"] + sample + ["EOT"]
-        metadata = self.metadata[index]
-        return sample, metadata
+        return self.encoded_data[self.offsets[index]:self.offsets[index + 1]], self.metadata[index]
     
     def collate(self, data):
         """
         collate function
         """
-        masks = []
-        token_lists = []
         metadatas = []
         
         max_lenth = max([len(item[0]) for item in data])
-        for tokens_, metadata in data: 
-            
-            mask = [1] * len(tokens_) + [0] * (max_lenth - len(tokens_))
-            tokens = self.dictionary.encode(tokens_ + [self.dictionary.pad()] * (max_lenth - len(tokens_)))
-
-            # pdb.set_trace()
-            token_lists.append(tokens)
+        token_lists = np.full((len(data), max_lenth), self._pad_tok, dtype=np.int64)
+        masks = np.zeros((len(data), max_lenth), dtype=np.int64)
+        for i, (tokens, metadata) in enumerate(data): 
 
-            masks.append(mask)
+            token_lists[i, :len(tokens)] = tokens
+            masks[i, :len(tokens)] = 1
             metadatas.append(metadata)
 
-        token_lists = torch.tensor(token_lists)
-        masks = torch.tensor(masks)
+        token_lists = torch.from_numpy(token_lists)
+        masks = torch.from_numpy(masks)
         return {
             "data" : token_lists,
             "mask": masks,
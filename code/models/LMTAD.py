@@ -274,7 +274,8 @@ class LMTAD(nn.Module):
         # Create AdamW optimizer and use the fused version if it is available
         fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
         use_fused = fused_available and device_type == 'cuda'
-        extra_args = dict(fused=True) if use_fused else dict()
+        # otherwise fall back to the multi-tensor (foreach) implementation
+        extra_args = dict(fused=True) if use_fused else dict(foreach=True)
         optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=betas, **extra_args)
 
         message=f"using fused AdamW: {use_fused}"
@@ -4,6 +4,8 @@ import os
 import math
 import argparse
 from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 from typing import List
 from tqdm import tqdm
 from collections import defaultdict
@@ -15,6 +17,7 @@ from torch.utils.data.sampler import SubsetRandomSampler
 
 
 from datasets import (VocabDictionary, 
+                      BucketSampler,
                       POLConfig,
                       POLDataset,
                       PortoConfig,
@@ -46,6 +49,10 @@ def get_parser():
     parser.add_argument('--data_dir', type=str, default='')
     parser.add_argument('--data_file_name', type=str, default='data')
     parser.add_argument('--batch_size', type=int, default=64)
+    # batch trajectories of similar length together to reduce padding
+    parser.add_argument('--length_bucketing', action='store_true', required=False)
+    # number of background processes loading the batches, 0 loads them in the main process
+    parser.add_argument('--num_workers', type=int, default=min(8, os.cpu_count() or 1))
     parser.add_argument('--block_size', type=int, default=128)
     parser.add_argument('--grid_leng', type=int, default=25)
     parser.add_argument('--dataset', type=str, default="pol", choices=["porto", "pol"])
@@ -80,7 +87,10 @@ def get_parser():
     parser.add_argument('--decay_lr', type=bool, default=True)
 
     parser.add_argument('--grad_clip', type=float, default=1.0)
-    parser.add_argument('--compile', action='store_false')
+    # compile the model on cuda, use --no-compile to run it eagerly
+    parser.add_argument('--compile', action=argparse.BooleanOptionalAction, default=True)
+    # reduce-overhead records a cuda graph per input shape, and the batches are padded to their own longest sequence
+    parser.add_argument('--compile_mode', type=str, default="default", choices=["default", "reduce-overhead", "max-autotune"])
     parser.add_argument('--debug', action='store_true', required=False)
 
     args = parser.parse_args()
@@ -101,25 +111,100 @@ def get_lr(it, args):
     coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio)) # coeff ranges 0..1
     return args.min_lr + coeff * (args.lr - args.min_lr)
 
+# checkpoints are written to disk by a single background thread, with at most one save in flight
+ckpt_executor = ThreadPoolExecutor(max_workers=1)
+pending_ckpt = None
+
+def copy_to_cpu(obj, memo=None):
+    """snapshot the tensors of a (nested) state dict on the cpu"""
+    # shared tensors, like the tied embedding and lm_head weights, are copied once
+    memo = {} if memo is None else memo
+    if isinstance(obj, torch.Tensor):
+        key = (obj.device, obj.data_ptr(), obj.dtype, obj.shape, obj.stride())
+        if key not in memo:
+            # cpu tensors are cloned so that the next optimizer steps do not change the saved values
+            memo[key] = obj.detach().to("cpu", non_blocking=True) if obj.is_cuda else obj.detach().clone()
+        return memo[key]
+    if isinstance(obj, dict):
+        return {key: copy_to_cpu(value, memo) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(value, memo) for value in obj)
+    return obj
+
+def wait_for_checkpoint():
+    """block until the checkpoint being written, if any, is on disk"""
+    global pending_ckpt
+    if pending_ckpt is not None:
+        pending_ckpt.result()
+        pending_ckpt = None
+
+def save_checkpoint(checkpoint, path):
+    """copy the checkpoint to the cpu and write it to disk in the background"""
+    global pending_ckpt
+    wait_for_checkpoint()
+    checkpoint = copy_to_cpu(checkpoint)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize() # the copies to the cpu are asynchronous
+    pending_ckpt = ckpt_executor.submit(torch.save, checkpoint, path)
+
+def get_batch(data, device):
+    """copy the batch to the device once and shift it there into inputs and targets"""
+    # the shift is kept out of collate, with pin_memory every tensor of the batch dict would be pinned and copied on its own
+    batch = data["data"]
+    # the loaders pin the batches already, this only covers batches coming from unpinned loaders
+    if device == "cuda" and not batch.is_pinned():
+        batch = batch.pin_memory()
+    batch = batch.to(device, non_blocking=True)
+    # the loss flattens the targets with view, so they have to be contiguous
+    return batch[:, :-1], batch[:, 1:].contiguous()
+
+def prefetch_batches(dataloader, device, copy_stream=None):
+    """yield the (inputs, targets) of each batch, copying the next batch on copy_stream while the current one is used"""
+    if copy_stream is None:
+        for data in dataloader:
+            yield get_batch(data, device)
+        return
+
+    pending = None
+    for data in dataloader:
+        with torch.cuda.stream(copy_stream):
+            batch = get_batch(data, device)
+            copied = torch.cuda.Event()
+            copied.record(copy_stream)
+        if pending is not None:
+            yield wait_for_batch(*pending)
+        pending = (batch, copied)
+    if pending is not None:
+        yield wait_for_batch(*pending)
+
+def wait_for_batch(batch, copied):
+    """make the current stream wait for the copy of the batch before using it"""
+    current_stream = torch.cuda.current_stream()
+    current_stream.wait_event(copied)
+    for tensor in batch:
+        # the tensors were allocated on the copy stream, keep their memory until the current stream is done with them
+        tensor.record_stream(current_stream)
+    return batch
+
 # helps estimate an arbitrarily accurate loss over either split using many batches
-@torch.no_grad()
+@torch.inference_mode()
 def estimate_loss(args, model, test_dataloader, device, ctx):
     out = {}
-    model.eval()
     # pdb.set_trace()
     # for split in ['train', 'val']:
-    losses = torch.zeros(len(test_dataloader))
+    # sum the losses on the device and copy the mean to the host once at the end
+    losses = torch.zeros((), device=device)
+    n_batches = 0
     for batch, data in enumerate(test_dataloader):
-        X = data["data"][:, :-1].contiguous().to(device) # was throughing some erros if not contiguous
-        Y = data["data"][:, 1:].contiguous().to(device)
+        X, Y = get_batch(data, device)
         with ctx:
             logits, loss = model(X, Y)
-        losses[batch] = loss.item()
+        losses += loss.float()
+        n_batches += 1
         # out[split] = losses.mean()
-    model.train()
-    return losses.mean()
+    return (losses / n_batches).item()
 
-@torch.no_grad()
+@torch.inference_mode()
 def model_eval(args,
          epoch,
          iter_num, 
@@ -141,35 +226,36 @@ def model_eval(args,
     # pdb.set_trace()
     log(f"|step {iter_num}:  val loss {val_loss:.4f}|", args.log_file)
     saved_model_eval = False
-    # if val_loss < best_val_loss: #or always_save_checkpoint:
-        
-    best_val_loss = val_loss
-    if iter_num > 0:
-        checkpoint = {
-            'model': model.state_dict(),
-            'optimizer': optimizer.state_dict(),
-            'model_config': model_conf,
-            'iter_num': iter_num,
-            'best_val_loss': best_val_loss,
-            'dataset_config': dataset_config,
-            "args": args
-        }
-
-        log_output = f"\nsaving checkpoint to {args.out_dir}"
-        if args.output_file_name != "":
-            ckpt_name = f"ckpt_{args.output_file_name}"
-        else:
-            ckpt_name = f"ckpt"
-
-        ckpt_name += f"epoch_{epoch}_batch_{iter_num}.pt"
 
-        torch.save(checkpoint, os.path.join(args.out_dir, ckpt_name))
+    if iter_num > 0:
+        log_output = ""
+        # only write a checkpoint when the validation loss improved
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            checkpoint = {
+                'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'model_config': model_conf,
+                'iter_num': iter_num,
+                'best_val_loss': best_val_loss,
+                'dataset_config': dataset_config,
+                "args": args
+            }
+
+            log_output += f"\nsaving checkpoint to {args.out_dir}"
+            if args.output_file_name != "":
+                ckpt_name = f"ckpt_{args.output_file_name}"
+            else:
+                ckpt_name = f"ckpt"
+
+            ckpt_name += f"epoch_{epoch}_batch_{iter_num}.pt"
+
+            save_checkpoint(checkpoint, os.path.join(args.out_dir, ckpt_name))
+            saved_model_eval = True
 
         # ipdb.set_trace()
         if args.debug and args.dataset == "pol":
-            model.eval()
             results = eval_pattern_of_life(kwargs["test_dataset_config"], model, device, kwargs["dictionary"], kwargs["dataloader"])
-            model.train()
             df_results = pd.DataFrame(results)
 
             red_outliers = [546, 644, 347, 62, 551, 992, 554, 949, 900, 57] # TODO parametirize this. Now we only care about the red outliers
@@ -184,7 +270,7 @@ def model_eval(args,
             metric_results["avg_pr_auc"].append(df_results.pr_auc.mean())
 
         elif args.debug and args.dataset == "porto":   
-            results = eval_porto(model=model, device=device, dataloader=kwargs["dataloader"])
+            results = eval_porto(model=model, device=device, dataloader=kwargs["dataloader_future"].result())
             df_results = pd.DataFrame(results)            
             
             (_, _, _, _, f1, pr_auc), treshold = get_metrics(df_results[df_results["outlier"] != "detour outlier"], "log_perplexity")
@@ -200,31 +286,40 @@ def model_eval(args,
             metric_results["pr_auc_detour"].append(pr_auc)
             log_output += f"| detour outliers -> f1: {f1:.3f} | pr_auc: {pr_auc:.3f} |\n"
         
-        log(log_output, args.log_file)
+        if log_output:
+            log(log_output, args.log_file)
     
-    saved_model_eval = True
     model.train()
-    return best_val_loss, saved_model_eval
+    return best_val_loss, val_loss, saved_model_eval
 
 def main(args):
     """train orchastration"""
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
-
-    dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32', 'bfloat16', or 'float16', the latter will 
+    # allow tf32 on the tensor cores for matmuls and cudnn, and let cudnn pick the fastest kernels
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision("high")
+
+    if device == 'cpu':
+        # train in full precision on the cpu, without autocast and without the GradScaler
+        dtype = 'float32'
+    else:
+        dtype = 'bfloat16' if torch.cuda.is_bf16_supported() else 'float16' # 'float32', 'bfloat16', or 'float16', the latter will 
     ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
-    ctx = nullcontext() if device == 'cpu' else torch.amp.autocast(device_type=device, dtype=ptdtype)
+    ctx = nullcontext() if dtype == 'float32' else torch.amp.autocast(device_type=device, dtype=ptdtype)
 
     if args.dataset == "pol":
         args.features = args.features.split(",")
         args.include_outliers = True
 
-        features_folder_name = save_file_name_pattern_of_life(args.features)
-        args.out_dir = f"{args.out_dir}/outlier_{args.include_outliers}/{features_folder_name}/n_layer_{args.n_layer}_n_head_{args.n_head}_n_embd_{args.n_embd}_lr_{args.lr}_integer_poe_{args.integer_poe}"
+        features_name = save_file_name_pattern_of_life(args.features)
+        args.out_dir = f"{args.out_dir}/outlier_{args.include_outliers}/{features_name}/n_layer_{args.n_layer}_n_head_{args.n_head}_n_embd_{args.n_embd}_lr_{args.lr}_integer_poe_{args.integer_poe}"
 
         os.makedirs(f"{args.out_dir}", exist_ok=True)
 
-        output_file_name = save_file_name_pattern_of_life(args.features)
+        output_file_name = features_name
         log_file = f"{args.out_dir}/log.txt"
         args.log_file = log_file
         args.output_file_name = ""
@@ -291,116 +386,144 @@ def main(args):
         args.features = []
 
     train_indices, val_indices = dataset.partition_dataset()
-    
-
-    train_dataloader = DataLoader(dataset, batch_size=args.batch_size, collate_fn=dataset.collate, sampler=SubsetRandomSampler(train_indices))
-    val_dataloader = DataLoader(dataset, batch_size=args.batch_size, collate_fn=dataset.collate, sampler=SubsetRandomSampler(val_indices))
 
+    # load batches in background workers into pinned memory so that the host to device copies can be asynchronous
+    loader_kwargs = dict(collate_fn=dataset.collate, pin_memory=(device == "cuda"), num_workers=args.num_workers)
+    if args.num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+
+    def make_loader(loader_dataset, **kwargs):
+        if "batch_sampler" not in kwargs:
+            kwargs["batch_size"] = args.batch_size
+        return DataLoader(loader_dataset, **loader_kwargs, **kwargs)
+
+    compile_model = args.compile and device == "cuda"
+    if args.length_bucketing:
+        train_dataloader = make_loader(dataset, batch_sampler=BucketSampler(dataset.lengths, train_indices, args.batch_size))
+    else:
+        train_dataloader = make_loader(dataset, sampler=SubsetRandomSampler(train_indices))
+    val_dataloader = make_loader(dataset, sampler=SubsetRandomSampler(val_indices))
+
+    vocab_size = len(dataset.dictionary)
+    pad_token = dataset.dictionary.pad_token()
     model_args = dict(n_layer=args.n_layer, n_head=args.n_head, n_embd=args.n_embd, block_size=args.block_size, log_file=args.log_file,
-                  bias=False, vocab_size=len(dataset.dictionary), dropout=args.dropout, pad_token=dataset.dictionary.pad_token(), logging=True, integer_poe=args.integer_poe)
+                  bias=False, vocab_size=vocab_size, dropout=args.dropout, pad_token=pad_token, logging=True, integer_poe=args.integer_poe)
     
     model_conf = LMTADConfig(**model_args)
     model = LMTAD(model_conf)
 
-    model = model.to(device) # TODO maybe compile the model to speed up the training process? 
+    model = model.to(device)
     model.train()
     # compile the model
-    if not args.compile:
+    if compile_model:
         print("")
         log(f"compiling the model... (takes a ~minute)", args.log_file)
-        model = torch.compile(model) # requires PyTorch 2.0
+        model = torch.compile(model, mode=args.compile_mode) # requires PyTorch 2.0
 
     optimizer = model.configure_optimizers(args.weight_decay, args.lr, (args.beta1, args.beta2), device)
-    # initialize a GradScaler. If enabled=False scaler is a no-op
-    scaler = torch.cuda.amp.GradScaler(enabled=(dtype == 'float16'))    
+    # initialize a GradScaler. It is only needed for float16, the other dtypes step the optimizer directly
+    use_scaler = dtype == 'float16'
+    scaler = torch.cuda.amp.GradScaler() if use_scaler else None
     
     best_val_loss = 1e9
     t0 = time.time()
     train_losses = []
     valid_losses = []
-    cumul_train_loses = 0
+    # accumulate the training loss on the device, it is only copied to the host when it is logged
+    cumul_loss_gpu = torch.zeros((), device=device)
     cumulation = 1
     save_model_count = 3
     metric_results = defaultdict(list)
 
     # ipdb.set_trace()
-    eval_outliers_kwargs = None
+    eval_outliers_kwargs = {}
 
     if args.debug and args.dataset == "pol":
 
-        eval_outliers_kwargs = {}
-
-        test_dataloader = DataLoader(dataset, batch_size=args.batch_size, collate_fn=dataset.collate)
+        test_dataloader = make_loader(dataset)
         eval_outliers_kwargs["dataloader"] = test_dataloader
         eval_outliers_kwargs["test_dataset_config"] = dataset_config
         eval_outliers_kwargs["dictionary"]  = dataset.dictionary
         
     elif args.debug and args.dataset == "porto":    
         
-        eval_outliers_kwargs = {}
+        test_dataset_config = replace(dataset_config,
+                                      include_outliers=True,
+                                      outlier_level=3,
+                                      outlier_prob=0.1,
+                                      outlier_ratio=0.05,
+                                      outliers_list=["route_switch", "detour"])
 
-        test_dataset_config = PortoConfig(**vars(dataset_config))
-        test_dataset_config.include_outliers = True
-        test_dataset_config.outlier_level = 3
-        test_dataset_config.outlier_prob = 0.1
-        test_dataset_config.outlier_ratio = 0.05
-        test_dataset_config.outliers_list = ["route_switch", "detour"]
+        def load_test_dataloader():
+            return make_loader(PortoDataset(test_dataset_config))
 
+        # the test dataset is first needed at the end of the first epoch, load it in the background until then
         log('loading the metrics test dataset', args.log_file)
-        test_dataset = PortoDataset(test_dataset_config)
-        test_dataloader = DataLoader(test_dataset, batch_size=args.batch_size, collate_fn=dataset.collate)
-
-        eval_outliers_kwargs["dataloader"] = test_dataloader
+        loading_executor = ThreadPoolExecutor(max_workers=1)
+        eval_outliers_kwargs["dataloader_future"] = loading_executor.submit(load_test_dataloader)
+        loading_executor.shutdown(wait=False)
         eval_outliers_kwargs["test_dataset_config"] = test_dataset_config
         
     iter_num = 0
+    # evaluate at the first and the last batch of every epoch
+    n_batches = len(train_dataloader)
+    eval_at = n_batches - 1
+    param_groups = optimizer.param_groups
+    # copy the next batch to the gpu on a side stream while the current step runs
+    copy_stream = torch.cuda.Stream() if device == "cuda" else None
     for epoch in range(args.max_iters):
         save_model = False
         log('-' * 85, args.log_file)
-        for batch_id, data in enumerate(train_dataloader):
+        for batch_id, (inputs, targets) in enumerate(prefetch_batches(train_dataloader, device, copy_stream)):
 
             # determine and set the learning rate for this iteration
             lr = get_lr(iter_num, args) if args.decay_lr else args.lr
-            for param_group in optimizer.param_groups:
+            for param_group in param_groups:
                 param_group['lr'] = lr
-            
-            inputs = data["data"][:, :-1].contiguous().to(device) # was throughing some erros if not contiguous
-            targets = data["data"][:, 1:].contiguous().to(device)
-
-            if batch_id % (len(train_dataloader) - 1) == 0:
-                best_val_loss, saved_model_eval = model_eval(args,
-                                                       epoch, 
-                                                       batch_id, 
-                                                       model, 
-                                                       optimizer, 
-                                                       model_conf, 
-                                                       dataset_config, 
-                                                       val_dataloader, 
-                                                       device, 
-                                                       ctx, 
-                                                       best_val_loss,
-                                                       metric_results,
-                                                       **eval_outliers_kwargs)
+
+            # the model barely changed since the evaluation at the end of the previous epoch, so batch 0 is only evaluated once
+            if (epoch == 0 and batch_id == 0) or batch_id == eval_at:
+                best_val_loss, val_loss, saved_model_eval = model_eval(args,
+                                                                 epoch, 
+                                                                 batch_id, 
+                                                                 model, 
+                                                                 optimizer, 
+                                                                 model_conf, 
+                                                                 dataset_config, 
+                                                                 val_dataloader, 
+                                                                 device, 
+                                                                 ctx, 
+                                                                 best_val_loss,
+                                                                 metric_results,
+                                                                 **eval_outliers_kwargs)
 
                 if saved_model_eval:
                     save_model = saved_model_eval
 
+                cumul_train_loses = cumul_loss_gpu.item()
                 train_losses.append(cumul_train_loses/cumulation)
-                valid_losses.append(best_val_loss.item())
+                valid_losses.append(val_loss)
                 cumulation = 1
-                cumul_train_loses = 0
+                cumul_loss_gpu.zero_()
 
             # ipdb.set_trace()
             with ctx:
                 logits, loss = model(inputs, targets)
 
-            scaler.scale(loss).backward()
-            if args.grad_clip != 0.0:
-                scaler.unscale_(optimizer)
-                torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip)
+            if use_scaler:
+                scaler.scale(loss).backward()
+                if args.grad_clip != 0.0:
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip, foreach=True)
+
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                loss.backward()
+                if args.grad_clip != 0.0:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip, foreach=True)
 
-            scaler.step(optimizer)
-            scaler.update()
+                optimizer.step()
             optimizer.zero_grad(set_to_none=True)
 
             # timing and logging
@@ -408,9 +531,10 @@ def main(args):
             dt = t1 - t0
             t0 = t1
 
-            cumul_train_loses += loss.item()
+            cumul_loss_gpu += loss.detach()
             if batch_id % args.log_interval == 0:
-                log(f"|epoch {epoch+1}/{args.max_iters} | batch {batch_id+1}/{len(train_dataloader)}: loss {loss.item():.4f} \t| time {dt*1000:.2f}ms|", args.log_file)
+                loss_val = loss.detach().float().item()
+                log(f"|epoch {epoch+1}/{args.max_iters} | batch {batch_id+1}/{n_batches}: loss {loss_val:.4f} \t| time {dt*1000:.2f}ms|", args.log_file)
 
             cumulation += 1
             iter_num +=1 
@@ -427,6 +551,7 @@ def main(args):
         log('-' * 85, args.log_file)
         log(f"|save_model_count: {save_model_count} | lr: {lr}",  args.log_file)
     # res = model(train_dataset[:1, :-1], train_dataset[:1, 1:])
+    wait_for_checkpoint()
 
     losses_dict = {"train": train_losses, "val":valid_losses}
     losses_dict = pd.DataFrame(losses_dict)